@@ -1,9 +1,14 @@
 from snappy import *
+import snappy.SnapPy
+import db_utils
 from db_utils import encode_torsion, encode_matrices, db_hash
 import os, sys, time
 import sqlite3
 import binascii
+import itertools
+import pickle
 import re
+from multiprocessing import Pool, TimeoutError, cpu_count
 
 cusped_schema ="""
 CREATE TABLE %s (
@@ -21,7 +26,7 @@ CREATE TABLE %s (
 
 cusped_insert_query = """insert into %s
 (name, cusps, betti, torsion, volume, chernsimons, tets, hash, triangulation)
-values ('%s', %s, %s, X'%s', %s, %s, %s, X'%s', X'%s')"""
+values (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
 
 closed_schema ="""
 CREATE TABLE %s (
@@ -39,7 +44,7 @@ CREATE TABLE %s (
 
 closed_insert_query = """insert into %s
 (cusped, m, l, betti, torsion, volume, chernsimons, hash)
-values ('%s', %d, %d, %d, X'%s', %s, %s, X'%s')"""
+values (?, ?, ?, ?, ?, ?, ?, ?)"""
 
 nono_cusped_schema ="""
 CREATE TABLE %s (
@@ -56,7 +61,7 @@ CREATE TABLE %s (
 
 nono_cusped_insert_query = """insert into %s
 (name, cusps, betti, torsion, volume, tets, hash, triangulation)
-values ('%s', %s, %s, X'%s', %s, %s, X'%s', X'%s')"""
+values (?, ?, ?, ?, ?, ?, ?, ?)"""
 
 nono_closed_schema ="""
 CREATE TABLE %s (
@@ -73,14 +78,30 @@ CREATE TABLE %s (
 
 nono_closed_insert_query = """insert into %s
 (cusped, m, l, betti, torsion, volume, hash)
-values ('%s', %d, %d, %d, X'%s', %s, X'%s')"""
+values (?, ?, ?, ?, ?, ?, ?)"""
 
 USE_COBS = 1 << 7
 USE_STRING = 1 << 6
 epsilon = 0.000001
+batch_size = 2000
+block_size = 500
+cusped_rows_cache = 'census_rows.pkl'
+# Bump this whenever cusped_manifold_row, get_header or ambiguity_exists
+# change, so that cached rows computed by the old code are not reused.
+cusped_rows_version = 1
 
 closed_re = re.compile('(.*)\((.*),(.*)\)')
 
+# The database is built once from scratch, so we give up durability
+# for speed while loading it.  If the build fails, just run it again.
+bulk_load_pragmas = [
+    'PRAGMA journal_mode=OFF',
+    'PRAGMA synchronous=OFF',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA locking_mode=EXCLUSIVE',
+    'PRAGMA cache_size=-262144', # 256 MiB
+    ]
+
 def create_manifold_tables(connection):
     """
     Create the empty tables for our manifold database.
@@ -136,43 +157,50 @@ def insert_closed_manifold(connection, table, mfld):
     homology = mfld.homology()
     betti = homology.betti_number()
     divisors = [x for x in homology.elementary_divisors() if x > 0]
-    torsion = binascii.hexlify(encode_torsion(divisors))
-    volume = mfld.volume()
+    torsion = sqlite3.Binary(encode_torsion(divisors))
+    volume = float(mfld.volume())
     if mfld.is_orientable():
         try:
-            chernsimons = mfld.chern_simons()
-        except:
-            chernsimons = 'NULL'
-    hash = db_hash(mfld)
+            chernsimons = float(mfld.chern_simons())
+        except (RuntimeError, ValueError):
+            print 'Chern-Simons failed for %s'%mfld
+            chernsimons = None
+    hash = sqlite3.Binary(binascii.unhexlify(db_hash(mfld)))
     if mfld.is_orientable():
-        query = closed_insert_query%(
-            table, cusped, int(m), int(l), int(betti),
-            torsion, volume, chernsimons, hash)
+        query = closed_insert_query%table
+        row = (cusped, int(m), int(l), int(betti),
+               torsion, volume, chernsimons, hash)
     else:
-        query = nono_closed_insert_query%(
-            table, cusped, int(m), int(l), int(betti),
-            torsion, volume, hash)
-    connection.execute(query)
+        query = nono_closed_insert_query%table
+        row = (cusped, int(m), int(l), int(betti),
+               torsion, volume, hash)
+    try:
+        connection.execute(query, row)
+    except sqlite3.Error:
+        print 'Failed to insert %s into %s'%(mfld, table)
+        raise
     
-def insert_cusped_manifold(connection, table, mfld,
-                           is_link=False,
-                           use_string=False):
+def cusped_manifold_row(mfld, is_link=False, use_string=False):
     """
-    Insert a cusped manifold into the specified table.
+    Return the row of values describing a cusped manifold, in the
+    order expected by cusped_insert_query (or nono_cusped_insert_query
+    if the manifold is non-orientable).  The blob columns are plain
+    byte strings, so that rows can be sent between processes; use
+    bind_blobs before inserting them.
     """
     name = mfld.name()
     cusps = mfld.num_cusps()
     homology = mfld.homology()
     betti = homology.betti_number()
     divisors = [x for x in homology.elementary_divisors() if x > 0]
-    torsion = binascii.hexlify(encode_torsion(divisors))
-    volume = mfld.volume()
+    torsion = encode_torsion(divisors)
+    volume = float(mfld.volume())
     if mfld.is_orientable():
         try:
-            cs = mfld.chern_simons()
-        except ValueError:
+            cs = float(mfld.chern_simons())
+        except (RuntimeError, ValueError):
             print 'Chern-Simons failed for %s'%name
-            cs = 'NULL'
+            cs = None
     tets = mfld.num_tetrahedra()
     use_cobs, triangulation = get_header(mfld, is_link, use_string)
     if use_cobs:
@@ -189,57 +217,167 @@ def insert_cusped_manifold(connection, table, mfld,
         triangulation += mfld.without_hyperbolic_structure()._to_string()
     else:
         triangulation += mfld._to_bytes()
-    triangulation = binascii.hexlify(triangulation)
-    hash = db_hash(mfld)
+    hash = binascii.unhexlify(db_hash(mfld))
     if mfld.is_orientable():
-        query = cusped_insert_query%(
-            table, name, cusps, betti, torsion,
-            volume, cs, tets, hash, triangulation)
+        return (name, cusps, betti, torsion,
+                volume, cs, tets, hash, triangulation)
     else:
-        query = nono_cusped_insert_query%(
-            table, name, cusps, betti, torsion,
-            volume, tets, hash, triangulation)
-    connection.execute(query)
+        return (name, cusps, betti, torsion,
+                volume, tets, hash, triangulation)
+
+def bind_blobs(row):
+    """
+    Wrap the torsion, hash and triangulation of a cusped manifold row
+    so that sqlite stores them as blobs.
+    """
+    row = list(row)
+    for n in (3, -2, -1):
+        row[n] = sqlite3.Binary(row[n])
+    return tuple(row)
+
+def insert_cusped_rows(connection, query, rows):
+    """
+    Insert a sequence of cusped manifold rows using the given insert
+    query.  The rows are consumed lazily and inserted in batches, with
+    one transaction per batch.
+    """
+    rows = (bind_blobs(row) for row in rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        try:
+            with connection:
+                connection.executemany(query, batch)
+        except sqlite3.Error:
+            print 'Failed to insert the batch %s ... %s'%(
+                batch[0][0], batch[-1][0])
+            raise
+
+def insert_cusped_manifolds(connection, query, manifolds,
+                            is_link=False,
+                            use_string=False):
+    """
+    Insert a sequence of cusped manifolds using the given insert query.
+    """
+    rows = (cusped_manifold_row(M, is_link, use_string) for M in manifolds)
+    insert_cusped_rows(connection, query, rows)
+
+def strip_names(manifolds):
+    """
+    Remove the Dehn filling coefficients from the names of the manifolds.
+    """
+    for M in manifolds:
+        M.set_name(M.name().split('(')[0])
+        yield M
+
+def init_census_worker():
+    """
+    Open the orientable cusped census once in each worker process of
+    make_cusped, rather than once per manifold.
+    """
+    global worker_census
+    worker_census = OrientableCuspedCensus()
+
+def orientable_cusped_block(bounds):
+    """
+    Return the rows for the manifolds in the orientable cusped census
+    with index in range(*bounds).  This is run in the worker processes
+    of make_cusped.  The slice is fetched with a single query, which
+    avoids one OFFSET scan per manifold.
+    """
+    start, stop = bounds
+    return [cusped_manifold_row(M)
+            for M in strip_names(worker_census[start:stop])]
+
+def next_result(results):
+    """
+    Return the next result of a Pool.imap.  Waiting without a timeout
+    ignores KeyboardInterrupt, so we wake up every second instead.
+    """
+    while True:
+        try:
+            return results.next(1)
+        except TimeoutError:
+            pass
+
+def orientable_cusped_rows():
+    """
+    Return the rows for the orientable cusped census.  Computing them
+    is deterministic, so they are saved in cusped_rows_cache and
+    reused until SnapPy, db_utils, the census data or
+    cusped_rows_version changes.  Editing the schemas in this script
+    does not invalidate the cache.
+    """
+    census = OrientableCuspedCensus()
+    # The main database of the census connection is its data file.
+    census_file = census._connection.execute(
+        'pragma database_list').fetchone()[2]
+    sources = [snappy.SnapPy.__file__, db_utils.__file__, census_file]
+    if (os.path.exists(cusped_rows_cache) and
+        os.path.getmtime(cusped_rows_cache) >
+        max(os.path.getmtime(source) for source in sources)):
+        with open(cusped_rows_cache, 'rb') as cache:
+            version, rows = pickle.load(cache)
+        if version == cusped_rows_version:
+            return rows
+    # Computing the rows is the expensive part, so it is done by a
+    # pool of workers.  We use imap rather than imap_unordered so
+    # that the ids match the order of the census.
+    size = len(census)
+    blocks = [(start, min(start + block_size, size))
+              for start in range(0, size, block_size)]
+    pool = Pool(cpu_count(), initializer=init_census_worker)
+    try:
+        results = pool.imap(orientable_cusped_block, blocks)
+        rows = []
+        for block in blocks:
+            rows.extend(next_result(results))
+    except:
+        # Don't wait for the queued blocks if something went wrong.
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    # Write to a temporary file first, so that an interrupted dump
+    # cannot leave a truncated cache behind.
+    temp_file = cusped_rows_cache + '.tmp'
+    with open(temp_file, 'wb') as cache:
+        pickle.dump((cusped_rows_version, rows), cache,
+                    pickle.HIGHEST_PROTOCOL)
+    # On Windows, os.rename will not replace an existing file.
+    if os.path.exists(cusped_rows_cache):
+        os.remove(cusped_rows_cache)
+    os.rename(temp_file, cusped_rows_cache)
+    return rows
 
 def make_cusped(connection):
     table = 'orientable_cusped_census'
-    for M in OrientableCuspedCensus():
-        M.set_name(M.name().split('(')[0])
-        insert_cusped_manifold(connection, table, M)
-    connection.commit()
-    # This index makes it fast to join this table on its name column.
-    # Without the index, the join is very slow.
-    connection.execute(
-        'create index o_cusped_by_name on orientable_cusped_census (name)')
+    insert_cusped_rows(connection, cusped_insert_query%table,
+                       orientable_cusped_rows())
 
 def make_links(connection):
     table = 'link_exteriors'
-    for n in range(1, 6):
-        for M in LinkExteriors(n):
-            M.set_name(M.name().split('(')[0])
-            insert_cusped_manifold(connection, table, M,
-                                   is_link=True)
-    connection.commit()
+    manifolds = (M for n in range(1, 6) for M in LinkExteriors(n))
+    insert_cusped_manifolds(connection, cusped_insert_query%table,
+                            strip_names(manifolds), is_link=True)
 
 def make_morwen_links(connection):
     table = 'morwen_links'
-    for n in range(1, 8):
-        m=1
-        for M in MorwenLinks(n):
-            M.set_name(M.name().split('(')[0])
-            print '%s %s %s'%(n, m, M.name())
-            m += 1
-            insert_cusped_manifold(connection, table, M,
-                                   is_link=True)
-    connection.commit()
+    def manifolds():
+        for n in range(1, 8):
+            m=1
+            for M in strip_names(MorwenLinks(n)):
+                print '%s %s %s'%(n, m, M.name())
+                m += 1
+                yield M
+    insert_cusped_manifolds(connection, cusped_insert_query%table,
+                            manifolds(), is_link=True)
 
 def make_census_knots(connection):
     table = 'census_knots'
-    for M in CensusKnots():
-        M.set_name(M.name().split('(')[0])
-        insert_cusped_manifold(connection, table, M,
-                               is_link=True)
-    connection.commit()
+    insert_cusped_manifolds(connection, cusped_insert_query%table,
+                            strip_names(CensusKnots()), is_link=True)
 
 def make_closed(connection):
     table = 'orientable_closed_census'
@@ -249,9 +387,8 @@ def make_closed(connection):
 
 def make_nono_cusped(connection):
     table = 'nonorientable_cusped_census'
-    for M in NonorientableCuspedCensus():
-        insert_cusped_manifold(connection, table, M)
-    connection.commit()
+    insert_cusped_manifolds(connection, nono_cusped_insert_query%table,
+                            NonorientableCuspedCensus())
 
 def make_nono_closed(connection):
     table = 'nonorientable_closed_census'
@@ -259,11 +396,26 @@ def make_nono_closed(connection):
         insert_closed_manifold(connection, table, M)
     connection.commit()
 
+def make_indexes(connection):
+    """
+    Index the cusped tables on their name columns.  These indexes make
+    it fast to join the closed tables to the cusped ones; without them
+    the joins are very slow.  They are created after all of the data
+    has been loaded, to avoid maintaining them during the inserts.
+    """
+    with connection:
+        connection.execute('create index if not exists o_cusped_by_name '
+                           'on orientable_cusped_census (name)')
+        connection.execute('create index if not exists n_cusped_by_name '
+                           'on nonorientable_cusped_census (name)')
+
 if __name__ == '__main__':
     dbfile = 'manifolds.sqlite'
     if os.path.exists(dbfile):
         os.remove(dbfile)
     connection = sqlite3.connect(dbfile)
+    for pragma in bulk_load_pragmas:
+        connection.execute(pragma)
     create_manifold_tables(connection)
     make_closed(connection)
     make_cusped(connection)
@@ -271,6 +423,7 @@ if __name__ == '__main__':
     make_census_knots(connection)
     make_nono_cusped(connection)
     make_nono_closed(connection)
+    make_indexes(connection)
     # There are two reasons for using views.  One is that views
     # are read-only, so we have less chance of deleting our data.
     # The second is that they allow joins to be treated as if they
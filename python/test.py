@@ -1,23 +1,33 @@
 from __future__ import print_function
-import doctest, inspect, os, sys, getopt, collections
+import doctest, inspect, os, sys, argparse, collections, contextlib, io
+import multiprocessing
 import snappy
 import snappy.snap.test
 import spherogram.test
 import snappy.matrix
 import snappy.verify.test
 import snappy.ptolemy.test
-import snappy.raytracing.cohomology_fractal
-import snappy.raytracing.geodesic
-import snappy.raytracing.geodesics
-import snappy.raytracing.ideal_raytracing_data
-import snappy.raytracing.upper_halfspace_utilities
 import snappy.drilling
 
 from snappy.sage_helper import (_within_sage, doctest_modules, cyopengl_works,
-                                tk_root, root_is_fake, DocTestParser)
+                                tk_root, root_is_fake, DocTestParser,
+                                print_results)
 from snappy import numeric_output_checker
 modules = []
 
+def _mod(name):
+    # Most of these are already imported by snappy, so look in
+    # sys.modules first and only fall back to the import machinery.
+    return sys.modules.get(name) or __import__(name, fromlist=['_'])
+
+raytracing_modules = [
+    _mod('snappy.raytracing.' + name)
+    for name in ['cohomology_fractal',
+                 'geodesic',
+                 'geodesics',
+                 'ideal_raytracing_data',
+                 'upper_halfspace_utilities']]
+
 snappy.database.Manifold = snappy.SnapPy.Manifold
 
 # Augment tests for SnapPy with those that Cython missed
@@ -27,51 +37,67 @@ missed_classes =   ['Triangulation', 'Manifold',
   'DirichletDomain', 'CuspNeighborhood', 'SymmetryGroup',
   'AlternatingKnotExteriors', 'NonalternatingKnotExteriors']
 
+snappy_cls = vars(snappy)
+snappy_tests = snappy.SnapPy.__test__
+snappyHP_tests = snappy.SnapPyHP.__test__
 for A in missed_classes:
-    snappy.SnapPy.__test__[A + '_extra'] = getattr(snappy, A).__doc__
-    snappy.SnapPyHP.__test__[A + '_extra'] = getattr(snappy, A).__doc__
+    snappy_tests[A + '_extra'] = snappy_cls[A].__doc__
+    snappyHP_tests[A + '_extra'] = snappy_cls[A].__doc__
 
 # some things we don't want to test at the extension module level
-identify_tests = [x for x in snappy.SnapPyHP.__test__
-                  if x.startswith('Manifold.identify')]
-triangulation_tests = [x for x in snappy.SnapPyHP.__test__
-                  if x.startswith('get_triangulation_tester')]
-browser_tests = [x for x in snappy.SnapPyHP.__test__
-                 if x.startswith('Manifold.browse')]
-for key in identify_tests + triangulation_tests + browser_tests:
-    snappy.SnapPyHP.__test__.pop(key)
+skipped_prefixes = ('Manifold.identify',
+                    'get_triangulation_tester',
+                    'Manifold.browse')
+snappy.SnapPyHP.__test__ = {key: test for key, test in snappyHP_tests.items()
+                            if not key.startswith(skipped_prefixes)}
+del snappy_tests, snappyHP_tests
 
 def snap_doctester(verbose):
     return snappy.snap.test.run_doctests(verbose, print_info=False)
 snap_doctester.__name__ = 'snappy.snap'
 
+@contextlib.contextmanager
+def restored_numbers():
+    """
+    Go back to Sage types (with the default accuracy) on the way out
+    of the block, whatever the code inside switched to.
+    """
+    try:
+        yield
+    finally:
+        snappy.number.Number._accuracy_for_testing = None
+        if _within_sage:
+            snappy.number.use_field_conversion('sage')
+
+@contextlib.contextmanager
+def snappy_numbers():
+    """
+    Use SnapPy numbers within the block and go back to Sage types on
+    the way out.  Outside of Sage the conversion is always 'snappy',
+    so it is left alone.
+    """
+    if _within_sage:
+        snappy.number.use_field_conversion('snappy')
+    with restored_numbers():
+        yield
+
 def snappy_database_doctester(verbose):
     # snappy_manifolds's tests is still relying on
     # SnapPy Number's _accuracy_for_testing.
     #
     # Switch to snappy conversion until snappy_manifolds is
     # is updated.
-    snappy.number.use_field_conversion('snappy')
-    snappy.number.Number._accuracy_for_testing = 8
-    ans = doctest_modules([snappy.database], verbose)
-    snappy.number.Number._accuracy_for_testing = None
-    if _within_sage:
-        snappy.number.use_field_conversion('sage')
-
-    return ans
+    with snappy_numbers():
+        snappy.number.Number._accuracy_for_testing = 8
+        return doctest_modules([snappy.database], verbose)
 snappy_database_doctester.__name__ = 'snappy.database'
 
 def spherogram_doctester(verbose):
-    ans = spherogram.test.run_doctests(verbose, print_info=False)
-
     # Spherogram's testing is switching to SnapPy numbers and
     # setting their accuracy.
     # Switch back to Sage types until Spherogram has been updated.
-    snappy.number.Number._accuracy_for_testing = None
-    if _within_sage:
-        snappy.number.use_field_conversion('sage')
-
-    return ans
+    with restored_numbers():
+        return spherogram.test.run_doctests(verbose, print_info=False)
 spherogram_doctester.__name__ = 'spherogram'
 
 def ptolemy_doctester(verbose):
@@ -88,12 +114,7 @@ modules += [snappy.SnapPy,
             snappy_database_doctester,
             snappy,
             snap_doctester,
-            snappy.matrix,
-            snappy.raytracing.cohomology_fractal,
-            snappy.raytracing.geodesic,
-            snappy.raytracing.geodesics,
-            snappy.raytracing.ideal_raytracing_data,
-            snappy.raytracing.upper_halfspace_utilities,
+            snappy.matrix] + raytracing_modules + [
             snappy.drilling,
             ptolemy_doctester,
             spherogram_doctester]
@@ -104,20 +125,58 @@ def snappy_verify_doctester(verbose):
 snappy_verify_doctester.__name__ = 'snappy.verify'
 modules.append(snappy_verify_doctester)
 
+def _run_one(index):
+    # Capture the failure reports so that the parent can print them
+    # with the results of the module they belong to.
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = doctest_modules([modules[index]], print_info=False)
+    return result, output.getvalue()
+
+def parallel_doctest_modules(verbose=False):
+    """
+    Like doctest_modules(modules), but with each module tested in a
+    fresh forked worker process, so that no module sees the global
+    state left behind by another.  The modules are passed to the
+    workers by index since module objects cannot be pickled.  The
+    output of each worker is printed just before the results for its
+    module.
+
+    Spawned workers would re-run the parent's __main__, which breaks
+    when that is e.g. setup.py, so without fork the tests are run
+    sequentially.  Verbose runs produce too much output to hold back,
+    so those are sequential too.
+    """
+    if verbose or 'fork' not in multiprocessing.get_all_start_methods():
+        return doctest_modules(modules, verbose=verbose)
+    context = multiprocessing.get_context('fork')
+    workers = min(len(modules), os.cpu_count() or 1)
+    with context.Pool(workers, maxtasksperchild=1) as pool:
+        results = pool.map(_run_one, range(len(modules)), chunksize=1)
+    failed, attempted = 0, 0
+    for module, (result, output) in zip(modules, results):
+        sys.stdout.write(output)
+        failed += result.failed
+        attempted += result.attempted
+        print_results(module, result)
+    print('\nAll doctests:\n   %s failures out of %s tests.' % (failed, attempted))
+    return doctest.TestResults(failed, attempted)
+
 def graphics_failures(verbose, windows, use_modernopengl):
     if cyopengl_works():
         print("Testing graphics ...")
         import snappy.CyOpenGL
         result = doctest_modules([snappy.CyOpenGL], verbose=verbose).failed
-        snappy.Manifold('m004').dirichlet_domain().view().test()
-        snappy.Manifold('m125').cusp_neighborhood().view().test()
-        if use_modernopengl:
-            snappy.Manifold('m004').inside_view().test()
+        for manifold_class in (snappy.Manifold, snappy.ManifoldHP):
+            # The Dirichlet domain works on a copy of M, so M can be
+            # shared with the inside view, which is created last since
+            # it keeps hold of M.
+            M = manifold_class('m004')
+            M.dirichlet_domain().view().test()
+            manifold_class('m125').cusp_neighborhood().view().test()
+            if use_modernopengl:
+                M.inside_view().test()
         snappy.Manifold('4_1').browse().test()
-        snappy.ManifoldHP('m004').dirichlet_domain().view().test()
-        snappy.ManifoldHP('m125').cusp_neighborhood().view().test()
-        if use_modernopengl:
-            snappy.ManifoldHP('m004').inside_view().test()
         if root_is_fake():
             root = tk_root()
             if root:
@@ -140,7 +199,7 @@ def runtests(verbose = False,
 
     DocTestParser.use_modernopengl = use_modernopengl
 
-    result = doctest_modules(modules, verbose=verbose)
+    result = parallel_doctest_modules(verbose=verbose)
     if not quick:
         print()
         # No idea why we mess and set snappy.database.Manifold
@@ -162,32 +221,24 @@ def runtests(verbose = False,
     return result.failed + num_graphics_failures
 
 if __name__ == '__main__':
-
-    verbose = False
-    quick = False
-    windows = False
-    use_modernopengl = True
-
-    try:
-        useful_args = [arg for arg in sys.argv[1:] if not arg.startswith('-psn_')]
-        optlist, args = getopt.getopt(
-            useful_args,
-            'ivqws',
-            ['ignore', 'verbose', 'quick', 'windows', 'skip-modern-opengl'])
-        opts = [o[0] for o in optlist]
-        if '-v' in opts or '--verbose' in opts:
-            verbose = True
-        if '-q' in opts or '--quick' in opts:
-            quick = True
-        if '-w' in opts or '--windows' in opts:
-            windows = True
-        if '-s' in opts or '--skip-modern-opengl' in opts:
-            use_modernopengl = False
-
-    except getopt.GetoptError:
+    parser = argparse.ArgumentParser(description='Run the SnapPy test suite.')
+    parser.add_argument('-i', '--ignore', action='store_true',
+                        help='ignored, for backwards compatibility')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print every doctest as it is run')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='skip the slower non-doctest tests')
+    parser.add_argument('-w', '--windows', action='store_true',
+                        help='leave the graphics windows open')
+    parser.add_argument('-s', '--skip-modern-opengl', action='store_true',
+                        help='skip the tests requiring modern OpenGL')
+    # macOS adds a -psn_* argument when launching an app.
+    args, unknown = parser.parse_known_args(
+        arg for arg in sys.argv[1:] if not arg.startswith('-psn_'))
+    if unknown:
         print("Could not parse arguments")
 
-    sys.exit(runtests(verbose = verbose,
-                      quick = quick,
-                      windows = windows,
-                      use_modernopengl = use_modernopengl))
+    sys.exit(runtests(verbose = args.verbose,
+                      quick = args.quick,
+                      windows = args.windows,
+                      use_modernopengl = not args.skip_modern_opengl))